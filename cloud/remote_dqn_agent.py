@@ -14,6 +14,9 @@ import struct
 import select
 import sys
 
+# wire format of the learning rate, read by the test bench as a single float32
+LEARNING_RATE_STRUCT = struct.Struct('<f')
+
 
 class RemoteDQNAgent(DQNAgent):
     """Keras-rl DQNAgent that receives recorded experiences via a tcp-interface, trains on the whole batch of data
@@ -89,8 +92,13 @@ class RemoteDQNAgent(DQNAgent):
 
         # create socket and bind, data receiving connection
         print("Starting remote RL server")
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
-        weights_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
+        self.data_socket = data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
+        self.weights_socket = weights_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
+        # rebind the ports right after a previous run instead of waiting for TIME_WAIT to expire
+        data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        weights_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # accepted connections inherit the buffer size; it has to hold a whole fetch of the test bench
+        data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
         data_socket.bind((self.address, self.data_port))
         weights_socket.bind((self.address, self.weights_port))
         print("Waiting for test bench to establish connection")
@@ -108,22 +116,13 @@ class RemoteDQNAgent(DQNAgent):
         print("XIL API connection established")
 
         # convert float data list to bytes
-        self.weightBufferSize = 1024
         self.architecture = []
         for _layer in self.model_weights:
             self.architecture.append(np.shape(_layer))
         arch_list = list(sum(self.architecture, ()))
-        b = bytes()
-        b = b.join((struct.pack('f', val) for val in arch_list))
-        # send bytes
-        if (len(b) < self.weightBufferSize):
-            self.weights_conn.send(b)
-        else:
-            for i in range(0, len(b) // self.weightBufferSize):
-                self.weights_conn.send(b[i * self.weightBufferSize:i * self.weightBufferSize + self.weightBufferSize])
-
-            if len(b) > ((i + 1) * self.weightBufferSize):
-                self.weights_conn.send(b[(i + 1) * self.weightBufferSize:])
+        b = np.asarray(arch_list, dtype='<f4').tobytes()
+        # send bytes, sendall takes care of partial writes
+        self.weights_conn.sendall(b)
         time.sleep(5)
         print("Done sending architecture")
 
@@ -133,31 +132,23 @@ class RemoteDQNAgent(DQNAgent):
                 _layer = np.ndarray.flatten(self.model_weights[_i])
             else:
                 _layer = self.model_weights[_i]
-            b = bytes()
-            b = b.join((struct.pack('f', val) for val in _layer))
-
-            # send bytes
-            if (len(b) < self.weightBufferSize):
-                self.weights_conn.send(b)
-            else:
-                for i in range(0, len(b) // self.weightBufferSize):
-                    self.weights_conn.send(b[i * self.weightBufferSize:i * self.weightBufferSize + self.weightBufferSize])
+            b = np.asarray(_layer, dtype='<f4').tobytes()
 
-                if len(b) > ((i + 1) * self.weightBufferSize):
-                    self.weights_conn.send(b[(i + 1) * self.weightBufferSize:])
+            # send bytes, sendall takes care of partial writes
+            self.weights_conn.sendall(b)
         print("Done sending weights")
 
         time.sleep(2.0)
 
-        b = bytes(self.learning_rate)
-        self.weights_conn.send(b)
+        b = LEARNING_RATE_STRUCT.pack(self.learning_rate)
+        self.weights_conn.sendall(b)
         print("Done sending learning rate")
 
-        data_communication = threading.Thread(target=self._recv_data, args=(verbose,))
-        data_communication.start()
+        self.data_communication = threading.Thread(target=self._recv_data, args=(verbose,))
+        self.data_communication.start()
 
-        weights_communication = threading.Thread(target=self._send_weights, args=())
-        weights_communication.start()
+        self.weights_communication = threading.Thread(target=self._send_weights, args=())
+        self.weights_communication.start()
 
         print("READY")
 
@@ -176,6 +167,13 @@ class RemoteDQNAgent(DQNAgent):
             # listen for data
             while select.select([self.data_conn], [], [], 0.0)[0]:
                 binary_data = self.data_conn.recv(self.data_send_buffer_size)
+                if not binary_data:
+                    # EOF: the test bench closes its connection after every batch (or close() shut it down);
+                    # select keeps reporting the socket as readable, so wait for the next connection instead
+                    if self.close_agent or not self._reaccept_data():
+                        return
+                    local_buffer = None  # a record cut off by the disconnect will not be continued
+                    break
                 float_data = np.frombuffer(binary_data, dtype=np.float32)
                 data_len = len(float_data)
 
@@ -216,30 +214,42 @@ class RemoteDQNAgent(DQNAgent):
             if self.close_agent:
                 return
 
+    def _reaccept_data(self, poll_interval=0.1):
+        """Replaces the closed data connection with the next one of the test bench.
+
+        Returns:
+            bool: False if the agent was closed while waiting for the test bench.
+        """
+        self.data_conn.close()
+        while not self.close_agent:
+            if select.select([self.data_socket], [], [], poll_interval)[0]:
+                data_conn, data_addr = self.data_socket.accept()
+                data_conn.setblocking(False)
+                self.data_conn = data_conn
+                return True
+        return False
+
     def _send_weights(self):
 
         # optional: outsource SendingWeights2ControlDesk to other process?
         try:
             while not self.close_agent:
                 if select.select([self.weights_conn], [], [], 0.0)[0]:
-                    self.weights_conn.recv(1024)
+                    if not self.weights_conn.recv(1024):
+                        # EOF: the weights connection is held for the whole run, so the test bench is gone;
+                        # the finally below stops the agent
+                        if not self.close_agent:
+                            print("Test bench closed the weights connection, stopping the agent")
+                        return
                     for _i, _layer_dim in enumerate(self.architecture):
                         if len(_layer_dim) > 0:
                             _layer = np.ndarray.flatten(self.model_weights[_i])
                         else:
                             _layer = self.model_weights[_i]
-                        b = bytes()
-                        b = b.join((struct.pack('f', val) for val in _layer))
-
-                        # send bytes
-                        if (len(b) < self.weightBufferSize):
-                            self.weights_conn.send(b)
-                        else:
-                            for i in range(0, len(b) // self.weightBufferSize):
-                                self.weights_conn.send(b[i * self.weightBufferSize:(i + 1) * self.weightBufferSize])
+                        b = np.asarray(_layer, dtype='<f4').tobytes()
 
-                            if len(b) > ((i + 1) * self.weightBufferSize):
-                                self.weights_conn.send(b[(i + 1) * self.weightBufferSize:])
+                        # send bytes, sendall takes care of partial writes
+                        self.weights_conn.sendall(b)
         finally:
             self.close_agent = True
 
@@ -247,9 +257,23 @@ class RemoteDQNAgent(DQNAgent):
     def close(self):
         """Closing function to terminate the threads and to close the interface"""
         self.close_agent = True
-        if hasattr(self, 'conn'):
-            self.weights_conn.close()
-            self.data_conn.close()
+        conns = [getattr(self, name, None) for name in ('weights_conn', 'data_conn')]
+        conns = [conn for conn in conns if conn is not None]
+        for conn in conns:
+            try:
+                # wakes the communication threads with EOF so they can leave select
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # test bench already disconnected
+        for name in ('data_communication', 'weights_communication'):
+            thread = getattr(self, name, None)
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        # read the connections again, _recv_data may have accepted a new one before it stopped
+        for name in ('weights_conn', 'data_conn', 'weights_socket', 'data_socket'):
+            sock = getattr(self, name, None)
+            if sock is not None:
+                sock.close()
 
 
     def backward_loop(self):
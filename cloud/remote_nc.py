@@ -1,15 +1,8 @@
 import numpy as np
 import time
 import threading
-from collections import deque
-import h5py
-import base64
-import io
-import csv
 import socket
-import struct
 import select
-import sys
 from mlace.utils.topology import DynamicComposite
 
 
@@ -84,8 +77,12 @@ class RemoteDynamicComposite(DynamicComposite):
 
         # create socket and bind, data receiving connection
         print("Starting remote RL server")
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
+        self.data_socket = data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
         # weights_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
+        # rebind the port right after a previous run instead of waiting for TIME_WAIT to expire
+        data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # accepted connections inherit the buffer size; it has to hold a whole fetch of the test bench
+        data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
         data_socket.bind((self.address, self.data_port))
         # weights_socket.bind((self.address, self.weights_port))
         print("Waiting for test bench to establish connection")
@@ -104,22 +101,13 @@ class RemoteDynamicComposite(DynamicComposite):
 
         # should be switched off
         # convert float data list to bytes
-        # self.weightBufferSize = 1024
         # self.architecture = []
         # for _layer in self.model_weights:
         #     self.architecture.append(np.shape(_layer))
         # arch_list = list(sum(self.architecture, ()))
-        # b = bytes()
-        # b = b.join((struct.pack('f', val) for val in arch_list))
-        # # send bytes
-        # if (len(b) < self.weightBufferSize):
-        #     self.weights_conn.send(b)
-        # else:
-        #     for i in range(0, len(b) // self.weightBufferSize):
-        #         self.weights_conn.send(b[i * self.weightBufferSize:i * self.weightBufferSize + self.weightBufferSize])
-
-        #     if len(b) > ((i + 1) * self.weightBufferSize):
-        #         self.weights_conn.send(b[(i + 1) * self.weightBufferSize:])
+        # b = np.asarray(arch_list, dtype='<f4').tobytes()
+        # # send bytes, sendall takes care of partial writes
+        # self.weights_conn.sendall(b)
         # time.sleep(5)
         # print("Done sending architecture")
 
@@ -128,30 +116,22 @@ class RemoteDynamicComposite(DynamicComposite):
         #         _layer = np.ndarray.flatten(self.model_weights[_i])
         #     else:
         #         _layer = self.model_weights[_i]
-        #     b = bytes()
-        #     b = b.join((struct.pack('f', val) for val in _layer))
+        #     b = np.asarray(_layer, dtype='<f4').tobytes()
 
-        #     # send bytes
-        #     if (len(b) < self.weightBufferSize):
-        #         self.weights_conn.send(b)
-        #     else:
-        #         for i in range(0, len(b) // self.weightBufferSize):
-        #             self.weights_conn.send(b[i * self.weightBufferSize:i * self.weightBufferSize + self.weightBufferSize])
-
-        #         if len(b) > ((i + 1) * self.weightBufferSize):
-        #             self.weights_conn.send(b[(i + 1) * self.weightBufferSize:])
+        #     # send bytes, sendall takes care of partial writes
+        #     self.weights_conn.sendall(b)
         # print("Done sending weights")
         ###
 
         time.sleep(2.0)
 
-        # b = bytes(self.learning_rate)
-        # self.weights_conn.send(b)
+        # b = struct.pack('<f', self.learning_rate)
+        # self.weights_conn.sendall(b)
         # print("Done sending learning rate")
 
-        data_communication = threading.Thread(
+        self.data_communication = threading.Thread(
             target=self._recv_data, args=(verbose,))
-        data_communication.start()
+        self.data_communication.start()
 
         # weights_communication = threading.Thread(target=self._send_weights, args=())
         # weights_communication.start()
@@ -167,29 +147,28 @@ class RemoteDynamicComposite(DynamicComposite):
         # Training Loop
 
         print("GO")
-        local_buffer = None
+        # bytes of an incomplete record are kept until the rest of it arrives;
+        # framing happens on whole records, so a recv may end anywhere (even inside a float)
+        record_size = self.measurement_length * 4
+        local_buffer = bytearray()
+        recv_view = memoryview(bytearray(self.data_send_buffer_size))  # reused by every recv
         while not self.close_agent:
 
             # listen for data
             while select.select([self.data_conn], [], [], 0.0)[0]:
-                binary_data = self.data_conn.recv(self.data_send_buffer_size)
-                float_data = np.frombuffer(binary_data, dtype=np.float32)
-                data_len = len(float_data)
-
-                full_dates_len = (
-                    data_len // self.measurement_length) * self.measurement_length
-                if local_buffer is None and data_len % self.measurement_length:
-                    local_buffer = float_data[full_dates_len:]
-                    float_data = float_data[:full_dates_len]
-                elif local_buffer is not None:
-                    try:
-                        local_buffer = np.append(local_buffer, float_data)
-                        float_data = local_buffer[:full_dates_len]
-                        local_buffer = local_buffer[full_dates_len:]
-                        if len(local_buffer) == 0:
-                            local_buffer = None
-                    except:
-                        raise
+                nb_bytes = self.data_conn.recv_into(recv_view)
+                if nb_bytes == 0:
+                    # EOF: the test bench closes its connection after every batch (or close() shut it down);
+                    # select keeps reporting the socket as readable, so wait for the next connection instead
+                    if self.close_agent or not self._reaccept_data():
+                        return
+                    del local_buffer[:]  # a record cut off by the disconnect will not be continued
+                    break
+                local_buffer += recv_view[:nb_bytes]
+
+                full_records_size = (len(local_buffer) // record_size) * record_size
+                float_data = np.frombuffer(local_buffer[:full_records_size], dtype=np.float32)
+                del local_buffer[:full_records_size]
                 try:
                     episode_data = np.reshape(
                         float_data, (self.measurement_length, -1), order="F")  # seems to be fine
@@ -219,6 +198,21 @@ class RemoteDynamicComposite(DynamicComposite):
             if self.close_agent:
                 return
 
+    def _reaccept_data(self, poll_interval=0.1):
+        """Replaces the closed data connection with the next one of the test bench.
+
+        Returns:
+            bool: False if the agent was closed while waiting for the test bench.
+        """
+        self.data_conn.close()
+        while not self.close_agent:
+            if select.select([self.data_socket], [], [], poll_interval)[0]:
+                data_conn, data_addr = self.data_socket.accept()
+                data_conn.setblocking(False)
+                self.data_conn = data_conn
+                return True
+        return False
+
     def _send_weights(self):
 
         # optional: outsource SendingWeights2ControlDesk to other process?
@@ -231,29 +225,28 @@ class RemoteDynamicComposite(DynamicComposite):
                             _layer = np.ndarray.flatten(self.model_weights[_i])
                         else:
                             _layer = self.model_weights[_i]
-                        b = bytes()
-                        b = b.join((struct.pack('f', val) for val in _layer))
-
-                        # send bytes
-                        if (len(b) < self.weightBufferSize):
-                            self.weights_conn.send(b)
-                        else:
-                            for i in range(0, len(b) // self.weightBufferSize):
-                                self.weights_conn.send(
-                                    b[i * self.weightBufferSize:(i + 1) * self.weightBufferSize])
+                        b = np.asarray(_layer, dtype='<f4').tobytes()
 
-                            if len(b) > ((i + 1) * self.weightBufferSize):
-                                self.weights_conn.send(
-                                    b[(i + 1) * self.weightBufferSize:])
+                        # send bytes, sendall takes care of partial writes
+                        self.weights_conn.sendall(b)
         finally:
             self.close_agent = True
 
     def close(self):
         """Closing function to terminate the threads and to close the interface"""
         self.close_agent = True
-        if hasattr(self, 'conn'):
+        if hasattr(self, 'data_conn'):
             # self.weights_conn.close()
+            try:
+                # wakes _recv_data with EOF so it can leave select before the socket goes away
+                self.data_conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # test bench already disconnected
+            receiver = getattr(self, 'data_communication', None)
+            if receiver is not None and receiver is not threading.current_thread():
+                receiver.join()
             self.data_conn.close()
+            self.data_socket.close()
 
     def backward_loop(self):
         # Storing of data into the memory has been outsourced from this fcn because one at a time is too few
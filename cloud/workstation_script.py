@@ -71,10 +71,13 @@ if __name__ == '__main__':
     # Time span
     ts = 1e-4  # env.physical_system.tau
     t0, tf = 0, 0.02  # initial and final time for controlling the system
-    t = torch.arange(t0, tf+ts, ts).to(device, dtype=torch.float32)
+    t = torch.arange(t0, tf+ts, ts, dtype=torch.float32, device=device)
 
-    # create env for easy access to the parameters; env itself is not in use
-    env = FastPMSM(x_star=x_star.cpu().numpy(),
+    # create env for easy access to the parameters (me_omega); the env is not simulated,
+    # but ClassicController is built from it in SysID mode, so it cannot be skipped
+    # FastPMSM takes numpy: on the CPU device this is a view on x_star's memory, no copy
+    # (on an accelerator it is a single device -> host copy at start-up)
+    env = FastPMSM(x_star=x_star.detach().cpu().numpy(),
                    batch_size=batch_size, saturated=saturated_mode)
 
     internal_model = ControlledPMSM(t, env.me_omega,
@@ -105,5 +108,7 @@ if __name__ == '__main__':
         x_star=x_star
     )
 
-    threading.Thread(target=input_parser, args=(agent,)).start()  # needed?
+    # input() blocks without holding the GIL, so this thread does not slow down training;
+    # daemon so that it does not keep the process alive once the agent has finished
+    threading.Thread(target=input_parser, args=(agent,), daemon=True).start()
     agent.start(verbose=2)
@@ -19,7 +19,10 @@ class NeuralNetworkDecoder:
             self.weight_shapes.append((architecture[_i * dims_per_layer + 2],))
 
         self.nb_neurons_per_layer = self.weight_shapes[0][1]
-        self.message_lens = []#
+
+        # every network message has the same size, so one receive buffer is reused for all of them
+        self.message_len = int(sum(np.prod(_i) for _i in self.weight_shapes)) * 4
+        self.recv_buffer = bytearray(self.message_len)
 
         self.experiment_name = experiment_name
 
@@ -31,34 +34,7 @@ class NeuralNetworkDecoder:
 
     def recv_first_network(self, socket):
 
-        model_weights = []
-        weights_array = None
-        for _i in self.weight_shapes:
-            nb_elements = np.prod(_i)
-            while weights_array is None or len(weights_array) < nb_elements:
-                binary_weights = socket.recv(1024)
-                self.message_lens.append(len(binary_weights))
-                if weights_array is None:
-                    weights_array = np.frombuffer(binary_weights, dtype=np.float32)
-                else:
-                    weights_array = np.append(weights_array, np.frombuffer(binary_weights, dtype=np.float32))
-
-
-            if len(weights_array) > nb_elements:
-                model_weights.append(np.reshape(weights_array[:nb_elements], _i))
-                weights_array = weights_array[nb_elements:]
-            else:
-                model_weights.append(np.reshape(weights_array, _i))
-                weights_array = None
-
-        _layer_message = []
-
-        self.message_len = np.sum(self.message_lens)
-
-        self.message_lens = [1024] * (self.message_len // 1024)
-        self.message_lens.append(self.message_len % 1024)
-
-        return model_weights
+        return self.recv_message(socket)
 
     def network_acquisition(self, socket, MAPort, nn_parameter_paths, updateTime, ValueFactory):
 
@@ -85,47 +61,60 @@ class NeuralNetworkDecoder:
 
     def recv_network(self, socket):
 
-        self.model_weights = []
-        weights_array = None
-        remaining_message_len = np.copy(self.message_len)
+        self.model_weights = self.recv_message(socket)
+
+    def recv_message(self, socket):
+        """ Receive one complete network message into the reused buffer and split it into the layer arrays """
+        view = memoryview(self.recv_buffer)
+        received = 0
+        while received < self.message_len:
+            nb_bytes = socket.recv_into(view[received:])
+            if nb_bytes == 0:
+                raise ConnectionError("Remote RL server closed the weights connection")
+            received += nb_bytes
+
+        # copy once, the buffer is overwritten by the next message
+        weights_array = np.frombuffer(self.recv_buffer, dtype=np.float32).copy()
+        model_weights = []
+        offset = 0
         for _i in self.weight_shapes:
-            nb_elements = np.prod(_i)
-            while weights_array is None or len(weights_array) < nb_elements:
-                next_snippet_len = 1024 if remaining_message_len >= 1024 else remaining_message_len
-                binary_weights = socket.recv(next_snippet_len)
-                remaining_message_len -= len(binary_weights)
-                if weights_array is None:
-                    weights_array = np.frombuffer(binary_weights, dtype=np.float32)
-                else:
-                    weights_array = np.append(weights_array, np.frombuffer(binary_weights, dtype=np.float32))
+            nb_elements = int(np.prod(_i))
+            model_weights.append(np.reshape(weights_array[offset:offset + nb_elements], _i))
+            offset += nb_elements
 
-            if len(weights_array) > nb_elements:
-                self.model_weights.append(np.reshape(weights_array[:nb_elements], _i))
-                weights_array = weights_array[nb_elements:]
-            else:
-                self.model_weights.append(np.reshape(weights_array, _i))
-                weights_array = None
+        return model_weights
+
+    def layer_matrix(self, weights, biases, pad_rows):
+        """ Build [weights.T | biases] zero padded to the fixed FPGA layer size (rows or columns) """
+        nb_inputs, nb_outputs = weights.shape
+        if pad_rows:
+            w = np.zeros((self.nb_neurons_per_layer, nb_inputs + 1))
+        else:
+            w = np.zeros((nb_outputs, self.nb_neurons_per_layer + 1))
+        w[:nb_outputs, :nb_inputs] = weights.T
+        w[:nb_outputs, nb_inputs] = biases
+        return w
 
     def apply_network_FPGA(self, socket, MAPort, nn_parameter_paths, ValueFactory):
         socket.send(bytes(1))
 
+        # resolve the .NET members once per update instead of once per layer
+        write = MAPort.Write
+        create_float_matrix = ValueFactory.CreateFloatMatrixValue
+        float_matrix = Array[Array[float]]
+
         for _i in range(self.nb_dense_layers):
-            w = np.transpose(np.append(self.model_weights[_i * 2], [self.model_weights[_i * 2 + 1]], axis=0))
-            w_shape = np.shape(w)
-            if _i == 0:
-                w = np.append(w, np.zeros([w_shape[0], self.nb_neurons_per_layer + 1 - w_shape[1]]), axis=1)
-            else:
-                w = np.append(w, np.zeros([self.nb_neurons_per_layer - w_shape[0], w_shape[1]]), axis=0)
+            w = self.layer_matrix(self.model_weights[_i * 2], self.model_weights[_i * 2 + 1], pad_rows=_i != 0)
 
             # if _i == self.nb_dense_layers - 1:
             #     w = np.append(w, np.zeros([self.nb_neurons_per_layer - w_shape[0], w_shape[1]]), axis=0)
             # else:
             #     w = np.append(w, np.zeros([w_shape[0], self.nb_neurons_per_layer + 1 - w_shape[1]]), axis=1)
 
-            MAPort.Write(
+            write(
                 nn_parameter_paths[_i],
-                ValueFactory.CreateFloatMatrixValue(
-                    Array[Array[float]](w.tolist())
+                create_float_matrix(
+                    float_matrix(w.tolist())
                 )
             )
 
@@ -150,12 +139,8 @@ class NeuralNetworkDecoder:
         for _i in range(self.nb_dense_layers):
             self.started_saving = True
 
-            w = np.transpose(np.append(self.model_weights[_i * 2], [self.model_weights[_i * 2 + 1]], axis=0))
-            w_shape = np.shape(w)
-            if _i == self.nb_dense_layers - 1:
-                w = np.append(w, np.zeros([self.nb_neurons_per_layer - w_shape[0], w_shape[1]]), axis=0)
-            else:
-                w = np.append(w, np.zeros([w_shape[0], self.nb_neurons_per_layer + 1 - w_shape[1]]), axis=1)
+            w = self.layer_matrix(self.model_weights[_i * 2], self.model_weights[_i * 2 + 1],
+                                  pad_rows=_i == self.nb_dense_layers - 1)
 
             checkpoint_path = self.experiment_name
             Path(checkpoint_path).mkdir(parents=True, exist_ok=True)
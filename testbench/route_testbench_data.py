@@ -39,7 +39,6 @@ Copyright 2021, dSPACE GmbH. All rights reserved.
 
 import json
 import clr
-import time
 
 # for TCP/IP connection
 import asyncio
@@ -54,14 +53,17 @@ from address import ADDRESS_SERVER, PORT_SERVER
 TCP_IP = "131.234.172.167" # IP Address of the workstation computer
 TCP_PORT_DATA = 1030  #
 TCP_PORT_WEIGHTS = 1031  #
-BUFFER_SIZE = 988 # = floor(1024 // (measurement_size * 4)) * (measurement_size * 4) # <- 4 = nb of bits per float
-b = bytes()  # byte container for dSPACE XIL API lists
+SOCKET_SEND_BUFFER = 1 << 20  # bytes, large enough to take a whole fetch in one write
+SOCKET_RECV_BUFFER = 1 << 20  # bytes, large enough to take a whole network on the weights socket
+SEND_QUEUE_SIZE = 8  # fetched blocks that may wait for the sender before the capture loop blocks
+VERBOSE = False  # per-fetch console output; flushing stdout every 10 ms costs more than the fetch itself
 # create socket and connect (deprecated, using asyncio instead)
 #data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
 #weights_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP
 
 clr.AddReference("System.Collections")
-from System import Array
+from System import Array, IntPtr, String
+from System.Runtime.InteropServices import Marshal
 from System.Collections.Generic import Dictionary
 
 # Load ASAM assemblies from the global assembly cache (GAC)
@@ -117,18 +119,36 @@ slaveTask = f"{slaveTaskPrefix}/{Task}" if slaveTaskPrefix != "" else Task
 MAPort_cfg_file = r"MAPortConfigDS1202.xml"
 
 
+def build_watchers(watcher_factory, defines):
+    """ Create the start and stop ConditionWatchers on the edges of CaptureTrigger """
+    start_watcher = watcher_factory.CreateConditionWatcher("posedge(CaptureTrigger,0.5)", defines)
+    stop_watcher = watcher_factory.CreateConditionWatcher("negedge(CaptureTrigger,0.5)", defines)
+    # duration based alternative (capture time in s): watcher_factory.CreateDurationWatcherByTimeSpan(1)
+    return start_watcher, stop_watcher
+
+
+def tune_data_socket(sock):
+    """ Disable Nagle and enlarge the send buffer for the sample stream """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SEND_BUFFER)
+
+
+def tune_weights_socket(sock):
+    """ Disable Nagle for the 1 byte weight requests and make room for a whole network, call before connect """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RECV_BUFFER)
+
+
 
 async def main():
     # find config file
-    MAPort_cfg_path = None
-    for p in Path.cwd().glob("**/*"):
-        if MAPort_cfg_file in str(p):
-            MAPort_cfg_path = p
-            print(f"Config file found at {MAPort_cfg_path}")
+    MAPort_cfg_path = next(Path.cwd().rglob(MAPort_cfg_file), None)
     if MAPort_cfg_path is None:
         raise FileNotFoundError(f"File {MAPort_cfg_file} not found")
+    print(f"Config file found at {MAPort_cfg_path}")
     DemoCapture = None
     DemoMAPort = None
+    sender_task = None
 
     try:
         # --------------------------------------------------------------------------
@@ -207,20 +227,16 @@ async def main():
         DemoDefines = Dictionary[str, str]()
         DemoDefines.Add('CaptureTrigger', start_var)
 
+        print("Creating ConditionWatchers...", end='')
+        DemoStartWatcher, DemoStopWatcher = build_watchers(MyWatcherFactory, DemoDefines)
+        print("...done.")
+
         # Negative Delay: Start Capturing 0.1s before StartTriggerCondition is met
         StartDelay = MyDurationFactory.CreateTimeSpanDuration(0.0)
-        print("Creating ConditionWatcher...", end='')
-        DemoStartWatcher = MyWatcherFactory.CreateConditionWatcher("posedge(CaptureTrigger,0.5)", DemoDefines)
         DemoCapture.SetStartTrigger(DemoStartWatcher, StartDelay)
-        print("...done.")
 
-        print("Creating DurationWatcher...", end="")
         StopDelay = MyDurationFactory.CreateTimeSpanDuration(0)
-        captureTime = 1
-        DemoStopWatcher = MyWatcherFactory.CreateConditionWatcher("negedge(CaptureTrigger,0.5)", DemoDefines)
-        #DemoStopWatcher = MyWatcherFactory.CreateDurationWatcherByTimeSpan(captureTime)
         DemoCapture.SetStopTrigger(DemoStopWatcher, StopDelay)
-        print("...done.")
 
         # --------------------------------------------------------------------------
         # Create CaptureResultMemoryWriter object
@@ -242,6 +258,7 @@ async def main():
 
         # establish socket for TCP/IP
         #data_socket.connect((TCP_IP, TCP_PORT_DATA))
+        # tune_weights_socket(weights_socket)  # before connect, so the negotiated window can use the larger buffer
         # weights_socket.connect((TCP_IP, TCP_PORT_WEIGHTS))
 
         await asyncio.sleep(2.0)
@@ -271,12 +288,7 @@ async def main():
 
         # print("Initializing network on MicroLabBox")
         # for _i in range(nn_decoder.nb_dense_layers):
-        #     w = np.transpose(np.append(weights[_i * 2], [weights[_i * 2 + 1]], axis=0))
-        #     w_shape = np.shape(w)
-        #     if _i == 0:
-        #         w = np.append(w, np.zeros([w_shape[0], nn_decoder.nb_neurons_per_layer + 1 - w_shape[1]]), axis=1)
-        #     else:
-        #         w = np.append(w, np.zeros([nn_decoder.nb_neurons_per_layer - w_shape[0], w_shape[1]]), axis=0)
+        #     w = nn_decoder.layer_matrix(weights[_i * 2], weights[_i * 2 + 1], pad_rows=_i != 0)
 
         #     DemoMAPort.Write(
         #         nn_parameter_paths[_i],
@@ -293,10 +305,13 @@ async def main():
         # )
 
         print("Waiting until Capture is running...")
-        async def capture_starts_running():
+        async def capture_starts_running(max_delay=0.02):
+            # back off from 1 ms so a quick state change is not rounded up to a full 20 ms poll
+            delay = 0.001
             while DemoCapture.State != CaptureState.eRUNNING:
-                await asyncio.sleep(0.02)
-            
+                await asyncio.sleep(delay)
+                delay = min(delay * 1.5, max_delay)
+
         await capture_starts_running()
 
         print("Starting to fetch data...\n")
@@ -305,23 +320,69 @@ async def main():
         # this data can be worked with while the capturing continues.
         # In case of this demo it is just printed into the console
         capture_count = 0
+        sent_samples = 0
         print("STARTING")
+        # The weights pipeline stays in threads of this process: network_acquisition writes through
+        # DemoMAPort, a .NET object that cannot be handed to another process, and both threads
+        # spend their time blocked in recv/input, which does not hold the GIL.
         # weights_socket.send(bytes(1))
         # threading.Thread(target=nn_decoder.network_acquisition,
-        #                  args=(weights_socket, DemoMAPort, nn_parameter_paths, updateTime, MyValueFactory,)).start()
-        # threading.Thread(target=nn_decoder.input_parser, args=()).start()
+        #                  args=(weights_socket, DemoMAPort, nn_parameter_paths, updateTime, MyValueFactory,),
+        #                  daemon=True).start()
+        # threading.Thread(target=nn_decoder.input_parser, args=(), daemon=True).start()
+
+        def extract_value(captured_result, task, var_lbl, _convert=convertIBaseValue,
+                          _float_vector=IFloatVectorValue, _float_vector_type=DataType.eFLOAT_VECTOR):
+            # globals are bound as default arguments, so the per-signal calls are local lookups
+            # returns the .NET array of the signal and whether it is a double[] that can be bulk copied
+            fcn_values = captured_result.ExtractSignalValue(task, var_lbl).FcnValues
+            # captured signals are float vectors; cast directly instead of the generic BASE_TYPES lookup
+            if fcn_values.Type == _float_vector_type:
+                return _float_vector(fcn_values).Value, True  # .NET double[]
+            return _convert(fcn_values).Value, False
+
+        # record block and float64 landing buffer reused by every fetch,
+        # only reallocated if a fetch outgrows them
+        pack_buffer = np.empty((4096, len(var_capture_l)), dtype='<f4')
+        copy_buffer = np.empty(4096, dtype=np.float64)
+
+        def extract_signals(captured_result, signals, _copy=Marshal.Copy, _ptr=IntPtr):
+            # one pass over the (task, variable) table, every signal goes straight into its column:
+            # one little-endian float32 record per sample, channels in capture order;
+            # the column assignment is the only float64 -> float32 conversion
+            nonlocal pack_buffer, copy_buffer
+            packed = None
+            for j, (task, var_lbl) in enumerate(signals):
+                values, is_double_array = extract_value(captured_result, task, var_lbl)
+                nb_samples = values.Length
+                if packed is None:
+                    if nb_samples > pack_buffer.shape[0]:
+                        nb_rows = max(nb_samples, 2 * pack_buffer.shape[0])
+                        pack_buffer = np.empty((nb_rows, len(signals)), dtype='<f4')
+                        copy_buffer = np.empty(nb_rows, dtype=np.float64)
+                    packed = pack_buffer[:nb_samples]
+                elif nb_samples != packed.shape[0]:
+                    # For MP applications, the number of samples fetched by the masterApplication and the
+                    # slaveApplication may be different. The buffers are sized from the first signal, so the lower
+                    # value for NSamples is used instead of copying past their end.
+                    nb_samples = min(nb_samples, packed.shape[0])
+                    packed = packed[:nb_samples]
+                if is_double_array:
+                    # one bulk copy out of the managed array instead of marshalling every element
+                    _copy(values, 0, _ptr(copy_buffer.ctypes.data), nb_samples)
+                    packed[:, j] = copy_buffer[:nb_samples]
+                else:
+                    # a bulk copy would reinterpret int/bool bits as doubles, convert element-wise instead
+                    packed[:, j] = np.fromiter(values, np.float64, nb_samples)
+            return packed
 
-        def extract_value(captured_result, var_lbl):
-            x = captured_result.ExtractSignalValue(slaveTask, var_lbl)
-            y = [i for i in convertIBaseValue(x.FcnValues).Value]
-            return y
-        
         def postprocessing(signal, trajectory_len=201):
 
             mask = signal[:,-1].astype('bool') # get manual trigger
-            datapoints = signal[mask].shape[0]
+            triggered = signal[mask] # boolean indexing copies, so do it only once
+            datapoints = triggered.shape[0]
             cut_off = datapoints % trajectory_len # only multiples of trajectory length
-            return signal[mask][:-cut_off] # cut off after a multiple is reached
+            return triggered[:datapoints - cut_off] # cut off after a multiple is reached
         
         async def tcp_echo_client(message):
             reader, writer = await asyncio.open_connection(
@@ -338,7 +399,7 @@ async def main():
             writer.close()
             await writer.wait_closed()
 
-        async def tcp_data_client(data):
+        async def tcp_data_client(blocks):
             is_connected = False
             wait_print_bit = False
             while not is_connected:
@@ -355,69 +416,87 @@ async def main():
                     wait_print_bit = not wait_print_bit
                     print(s, end='\r')
                     await asyncio.sleep(1)
-                    
-            print(f'Sending data.')
-            writer.write(data)
+
+            tune_data_socket(writer.get_extra_info('socket'))
+
+            if VERBOSE:
+                print(f'Sending data.')
+            # the transport keeps writing until all blocks are sent (like sendall)
+            writer.writelines(blocks)
             await writer.drain()
 
-            print('Close the connection')
+            if VERBOSE:
+                print('Close the connection')
             writer.close()
             await writer.wait_closed()
 
-
+        async def data_sender(queue):
+            # consumer: ships fetched blocks while the capture loop keeps fetching
+            finished = False
+            while not finished:
+                data = await queue.get()
+                if data is None:
+                    return
+                # blocks that queued up during the previous send go out in the same message
+                blocks = [data]
+                while not queue.empty():
+                    data = queue.get_nowait()
+                    if data is None:
+                        finished = True
+                        break
+                    blocks.append(data)
+                await tcp_data_client(blocks)
+
+        send_queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        sender_task = asyncio.create_task(data_sender(send_queue))
+
+        async def queue_for_sending(data):
+            # a sender that died (e.g. connection reset during drain) would leave put() blocked
+            # forever once the queue is full, so wait for whichever finishes first
+            put = asyncio.ensure_future(send_queue.put(data))
+            await asyncio.wait({put, sender_task}, return_when=asyncio.FIRST_COMPLETED)
+            if sender_task.done() and (data is not None or not put.done()):
+                put.cancel()
+                sender_task.result()  # re-raises the error that stopped the sender
+                raise RuntimeError("Data sender stopped before the capture finished")
+
+        # (task, variable) pairs to extract from every fetched CaptureResult,
+        # converted to .NET strings once instead of on every ExtractSignalValue call
+        slaveTaskNet = String(slaveTask)
+        capture_signals = [(slaveTaskNet, String(s)) for s in var_capture_l]
+
+        fetch = DemoCapture.Fetch  # bound once, looked up as a local in the loop
         while DemoCapture.State != CaptureState.eFINISHED:
             # time.sleep(0.00004) # sleep is for the weak
-            time.sleep(0.01) # sleep is for the weak
-            demo_captured_result = DemoCapture.Fetch(False)
+            await asyncio.sleep(0.01) # sleep is for the weak, but it lets the sender run
+            demo_captured_result = fetch(False)
             # nn_decoder.pipeline_active = False
 
             # --------------------------------------------------------------------------
             # Extract measured data from CaptureResult
             # --------------------------------------------------------------------------
-
-            
-
-            fetched_signals_arr = np.array([extract_value(demo_captured_result, s) for s in var_capture_l],
-                                            dtype=np.float32).T
-            
-
+            fetched_signals_arr = extract_signals(demo_captured_result, capture_signals)
             fetched_signals_arr = postprocessing(fetched_signals_arr)
 
-            fetched_signals_bytes = fetched_signals_arr.tobytes()
-
-
-            print(len(fetched_signals_bytes), 'bytes')
-            await tcp_data_client(fetched_signals_bytes)
-
-            # --------------------------------------------------------------------------
-            # Write the fetched data samples into the console window
-            # --------------------------------------------------------------------------
-
-            # For MP applications, the number of samples fetched by the masterApplication and the slaveApplication may be different.
-            # To avoid IndexOutOfBounds errors, the lower value for NSamples is used. For single processor platforms, both values are the same.
-
-            # for row in fetched_signals_arr:
-            #     # convert float array to bytes
-            #     b = row.tobytes()
+            # small fetches often hold no complete trajectory; don't serialize or connect for nothing
+            if fetched_signals_arr.shape[0] > 0:
+                # the postprocessed block is a fresh C-contiguous array, so a byte view avoids another copy
+                fetched_signals_bytes = memoryview(fetched_signals_arr).cast('B')
 
-            #     # asyncio.run(tcp_echo_client("Hello world!"))
-            #     asyncio.run(tcp_data_client(b))
-
-            #     # send bytes
-            #     # if (len(b) <= BUFFER_SIZE):
-            #     #     data_socket.send(b)
-            #     # else:
-            #     #     for i in range(0, len(b) // BUFFER_SIZE):
-            #     #         data_socket.send(b[i * BUFFER_SIZE:(i + 1) * BUFFER_SIZE])
-
-            #     #     if len(b) > ((i + 1) * BUFFER_SIZE):
-            #     #         data_socket.send(b[(i + 1) * BUFFER_SIZE:])
+                if VERBOSE:
+                    print(len(fetched_signals_bytes), 'bytes')
+                await queue_for_sending(fetched_signals_bytes)
+                sent_samples += fetched_signals_arr.shape[0]
 
             capture_count += 1
 
+        # flush the remaining blocks before leaving the capture
+        await queue_for_sending(None)
+        await sender_task
+
         #data_socket.close()
         #weights_socket.close()
-        print("Capturing finished.\n")
+        print(f"Capturing finished: {capture_count} fetches, {sent_samples} samples sent.\n")
         # nn_decoder.pipeline_active = False
 
         #print("Setting Trigger to 0.0 (off)\n")
@@ -453,6 +532,9 @@ async def main():
         if DemoMAPort != None:
             DemoMAPort.Dispose()
             DemoMAPort = None
+        # only still running if the capture loop was left by an exception
+        if sender_task is not None and not sender_task.done():
+            sender_task.cancel()
 
 
 if __name__ == "__main__":